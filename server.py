@@ -1,11 +1,25 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import re
+import time
+import random
+import cProfile
+import threading
+import math
+import bisect
+import heapq
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.engine import Engine
 
 
 def setup_sql_logger(app):
@@ -47,8 +61,8 @@ def setup_sql_logger(app):
     werkzeug_handler.setFormatter(formatter)
     werkzeug_logger.addHandler(werkzeug_handler)
     
-    sql_logger = logging.getLogger('sqlalchemy.engine')
-    sql_logger.setLevel(logging.DEBUG)
+    sql_logger = logging.getLogger('slow_queries')
+    sql_logger.setLevel(logging.WARNING)
     sql_logger.propagate = False
     
     sql_handler = RotatingFileHandler(
@@ -78,12 +92,354 @@ def log_response(func):
         return response
     return wrapper
 
+def coalesce(func):
+    """Identical concurrent GETs of one user share a single computation"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        user_id = session.get('user_id')
+        with coalesce_lock:
+            generation = write_generations.get(user_id, 0)
+        key = (user_id, generation, request.path, tuple(sorted(request.args.items(multi=True))))
+        
+        def compute():
+            response = app.make_response(func(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers)
+        
+        (data, status, headers), shared = single_flight.do(key, compute)
+        
+        with coalesce_lock:
+            counters = coalesce_counters.setdefault(request.endpoint, {'executed': 0, 'coalesced': 0})
+            counters['coalesced' if shared else 'executed'] += 1
+        if shared:
+            app.logger.info(f"Coalesced request to {request.path}")
+        
+        return app.response_class(data, status=status, headers=headers), status
+    return wrapper
+
+def is_admin():
+    return session.get('email') in app.config['ADMIN_EMAILS']
+
+def should_profile():
+    """Admins ask for a profile explicitly, everyone else is sampled"""
+    if request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1':
+        if is_admin():
+            return True
+    
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+def cleanup_profiles(profile_dir):
+    """Keeps only the newest PROFILE_MAX_FILES profiles on disk"""
+    profiles = []
+    for name in os.listdir(profile_dir):
+        if name.startswith('profile-') and name.endswith('.pstats'):
+            path = os.path.join(profile_dir, name)
+            try:
+                profiles.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed by a concurrent cleanup
+                pass
+    profiles.sort(reverse=True)
+    
+    for _, path in profiles[app.config['PROFILE_MAX_FILES']:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+slow_query_stats = {}
+slow_query_lock = threading.Lock()
+
+def normalize_statement(statement):
+    """Collapses whitespace and expanded IN lists so equal queries share a key"""
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return re.sub(r'\(\?(, \?)*\)', '(?...)', statement)
+
+def param_shape(parameters):
+    """Types of bound parameters, e.g. 'int, str*3'"""
+    if isinstance(parameters, dict):
+        parameters = list(parameters.values())
+    
+    shape = []
+    for value in parameters or ():
+        name = type(value).__name__
+        if shape and shape[-1][0] == name:
+            shape[-1][1] += 1
+        else:
+            shape.append([name, 1])
+    
+    return ', '.join(name if count == 1 else f'{name}*{count}' for name, count in shape)
+
+def explain_query_plan(conn, statement, parameters):
+    """SQLite plan rows, run on a separate cursor to keep the results intact"""
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_slow_query(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info['query_start_time'].pop()) * 1000
+    if duration_ms < app.config['SLOW_QUERY_MS']:
+        return
+    
+    plan = []
+    if conn.dialect.name == 'sqlite' and not executemany and statement.lstrip().upper().startswith('SELECT'):
+        try:
+            plan = explain_query_plan(conn, statement, parameters)
+        except Exception as e:
+            app.logger.warning(f"EXPLAIN QUERY PLAN failed: {e}")
+    
+    full_scan = any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+    route = request.path if has_request_context() else None
+    key = normalize_statement(statement)
+    
+    with slow_query_lock:
+        stats = slow_query_stats.setdefault(key, {
+            'statement': key,
+            'count': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'routes': set(),
+        })
+        stats['count'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['params'] = param_shape(parameters)
+        stats['plan'] = plan
+        stats['full_scan'] = full_scan
+        if route:
+            stats['routes'].add(route)
+    
+    logging.getLogger('slow_queries').warning(
+        f"{duration_ms:.1f} ms on {route or '-'}{' [FULL SCAN]' if full_scan else ''}: "
+        f"{key} | params: {param_shape(parameters)} | plan: {'; '.join(plan)}"
+    )
+
+class MemoryBucketStore:
+    """Token buckets kept in this process.
+    
+    A shared store (e.g. Redis) only needs the same take() method
+    and can be set as RATE_LIMIT_STORE to hold limits across workers.
+    """
+    
+    def __init__(self, max_keys=10000):
+        # least recently used first
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+    
+    def take(self, key, rate, burst, cost):
+        """Returns 0 if tokens were taken, otherwise seconds to wait"""
+        cost = min(cost, burst)
+        now = time.monotonic()
+        
+        with self.lock:
+            tokens, updated, _, _ = self.buckets.pop(key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / rate
+            self.buckets[key] = (tokens, now, rate, burst)
+            
+            if len(self.buckets) > self.max_keys:
+                self.prune(now)
+        
+        return wait
+    
+    def prune(self, now):
+        """Drops refilled buckets, they are equal to new ones, then the least recently used.
+        
+        Shrinks to 3/4 of max_keys so the scan runs at most once per max_keys/4 new keys.
+        """
+        for key, (tokens, updated, rate, burst) in list(self.buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self.buckets[key]
+        
+        while len(self.buckets) > self.max_keys * 3 // 4:
+            self.buckets.popitem(last=False)
+
+class ConcurrencyLimiter:
+    """WSGI middleware that sheds requests above the limit instead of queueing them"""
+    
+    def __init__(self, wsgi_app, limit):
+        self.wsgi_app = wsgi_app
+        self.slots = threading.BoundedSemaphore(limit)
+        self.shed = 0
+        self.lock = threading.Lock()
+    
+    def __call__(self, environ, start_response):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.shed += 1
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'application/json'),
+                ('Retry-After', '1')
+            ])
+            return [b'{"error": "Server busy"}']
+        
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            self.slots.release()
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result.
+    
+    Uses threading primitives, so it also works under gevent/eventlet
+    once they patch threading.
+    """
+    
+    def __init__(self, timeout=10):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.timeout = timeout
+    
+    def do(self, key, fn):
+        """Returns (result, shared), shared is True when another call computed it.
+        
+        Callers that wait longer than timeout for a stuck call compute the result themselves.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+        
+        if not leader:
+            if not call['done'].wait(self.timeout):
+                return fn(), False
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+        
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        
+        return call['result'], False
+
+single_flight = SingleFlight()
+coalesce_counters = {}
+write_generations = {}
+coalesce_lock = threading.Lock()
+
+def bump_write_generation(user_id):
+    """Reads started after a write must not join calls that began before it"""
+    with coalesce_lock:
+        write_generations[user_id] = write_generations.get(user_id, 0) + 1
+
+rate_limit_counters = {}
+rate_limit_lock = threading.Lock()
+
+def count_rate_limit(endpoint, outcome):
+    with rate_limit_lock:
+        counters = rate_limit_counters.setdefault(endpoint, {'allowed': 0, 'limited': 0})
+        counters[outcome] += 1
+
 app = Flask(__name__)
 app.secret_key = 'my-secret-key-here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['ADMIN_EMAILS'] = [
+    email.strip() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()
+]
+app.config['PROFILE_DIR'] = 'logs'
+app.config['PROFILE_MAX_FILES'] = 50
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_STORE'] = MemoryBucketStore()
+# tokens per second and bucket size
+app.config['RATE_LIMIT_USER'] = (20, 100)
+app.config['RATE_LIMIT_IP'] = (50, 300)
+app.config['RATE_LIMIT_COSTS'] = {
+    'get_tags': 5,
+    'get_meals': 5,
+}
+# extra per endpoint buckets on top of the global ones, e.g. {'get_meals': {'user': (1, 10)}}
+app.config['RATE_LIMIT_ROUTES'] = {}
+
+app.wsgi_app = ConcurrencyLimiter(app.wsgi_app, int(os.environ.get('MAX_CONCURRENT_REQUESTS', 32)))
 
 setup_sql_logger(app)
 
+@app.before_request
+def start_profiler():
+    if request.endpoint == 'static' or not should_profile():
+        return
+    
+    profiler = cProfile.Profile()
+    request.environ['profiler'] = (profiler, time.perf_counter())
+    profiler.enable()
+
+@app.teardown_request
+def stop_profiler(exc):
+    """Runs even when the view raised, failing requests are worth profiling too"""
+    profiler, started = request.environ.pop('profiler', (None, None))
+    if profiler is None:
+        return
+    
+    profiler.disable()
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    
+    profile_dir = app.config['PROFILE_DIR']
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    
+    route = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+    user = session.get('user_id', 'anon')
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    error = '-error' if exc is not None else ''
+    path = os.path.join(profile_dir, f'profile-{stamp}-{route}-u{user}-{duration_ms}ms{error}.pstats')
+    
+    profiler.dump_stats(path)
+    app.logger.info(f"Profile for {request.path} (user {user}, {duration_ms} ms) saved to {path}")
+    cleanup_profiles(profile_dir)
+
+@app.before_request
+def check_rate_limit():
+    if not app.config['RATE_LIMIT_ENABLED'] or not request.path.startswith('/api/'):
+        return
+    
+    store = app.config['RATE_LIMIT_STORE']
+    endpoint = request.endpoint or 'unknown'
+    cost = app.config['RATE_LIMIT_COSTS'].get(endpoint, 1)
+    
+    clients = {'ip': request.remote_addr}
+    if 'user_id' in session:
+        clients['user'] = session['user_id']
+    
+    route_limits = app.config['RATE_LIMIT_ROUTES'].get(endpoint, {})
+    limits = []
+    for scope, client in clients.items():
+        limits.append((f'{scope}:{client}', app.config[f'RATE_LIMIT_{scope.upper()}']))
+        if scope in route_limits:
+            limits.append((f'{scope}:{client}:{endpoint}', route_limits[scope]))
+    
+    for key, (rate, burst) in limits:
+        wait = store.take(key, rate, burst, cost)
+        if wait:
+            count_rate_limit(endpoint, 'limited')
+            app.logger.warning(f"Rate limit for {key} on {request.path}, retry in {wait:.2f} s")
+            return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': str(math.ceil(wait))}
+    
+    count_rate_limit(endpoint, 'allowed')
+
 db = SQLAlchemy(app)
 
 class User(db.Model):
@@ -104,9 +460,208 @@ class Recipe(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     tags = db.Column(db.Text, default='[]')
     rate = db.Column(db.SmallInteger, default=5)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    
+    __mapper_args__ = {'version_id_col': version}
+
+RECIPE_FIELDS = ('title', 'url', 'description', 'ingredients', 'content', 'tags', 'rate')
+
+def add_missing_columns():
+    """db.create_all() does not alter tables that already exist"""
+    columns = [column['name'] for column in inspect(db.engine).get_columns('recipe')]
+    if 'version' not in columns:
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("ALTER TABLE recipe ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
 
 with app.app_context():
     db.create_all()
+    add_missing_columns()
+
+class PrefixIndex:
+    """Sorted names with usage counts, completions are found with bisect"""
+    
+    def __init__(self):
+        self.keys = []
+        self.counts = {}
+    
+    def add(self, name, delta=1):
+        key = (name.lower(), name)
+        count = self.counts.get(name, 0) + delta
+        
+        if count > 0:
+            if name not in self.counts:
+                bisect.insort(self.keys, key)
+            self.counts[name] = count
+        elif name in self.counts:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            del self.counts[name]
+    
+    def complete(self, prefix, limit):
+        prefix = prefix.lower()
+        lo = bisect.bisect_left(self.keys, (prefix,))
+        hi = bisect.bisect_left(self.keys, (prefix + '\uffff',))
+        best = heapq.nlargest(limit, self.keys[lo:hi], key=lambda t: self.counts[t[1]])
+        return [{'name': name, 'count': self.counts[name]} for _, name in best]
+
+autocomplete_indexes = {}
+autocomplete_generations = {}
+autocomplete_pending = {}
+autocomplete_lock = threading.Lock()
+
+def load_json_list(value):
+    """Old rows and clients may hold null, invalid JSON or a non-list"""
+    try:
+        value = json.loads(value or '[]')
+    except ValueError:
+        return []
+    return value if isinstance(value, list) else []
+
+def recipe_terms(tags, ingredients):
+    """Distinct tags and ingredient names of one recipe, from their JSON columns.
+    
+    Items that are not strings (tags) or objects with a string name (ingredients) are skipped.
+    """
+    names = [
+        ingredient.get('name') for ingredient in load_json_list(ingredients)
+        if isinstance(ingredient, dict)
+    ]
+    return {
+        'tag': {tag.strip() for tag in load_json_list(tags) if isinstance(tag, str) and tag.strip()},
+        'ingredient': {name.strip() for name in names if isinstance(name, str) and name.strip()}
+    }
+
+def get_autocomplete_index(user_id):
+    """Built from the database on first use, then kept up to date by recipe writes.
+    
+    The build runs outside the lock. It is only kept if no write was in progress
+    when it started and none started since, otherwise the write could count twice.
+    """
+    with autocomplete_lock:
+        indexes = autocomplete_indexes.get(user_id)
+        generation = autocomplete_generations.get(user_id, 0)
+        pending = autocomplete_pending.get(user_id, 0)
+    if indexes is not None:
+        return indexes
+    
+    indexes = {'tag': PrefixIndex(), 'ingredient': PrefixIndex()}
+    rows = db.session.query(Recipe.tags, Recipe.ingredients).filter_by(user_id=user_id).all()
+    for tags, ingredients in rows:
+        for kind, names in recipe_terms(tags, ingredients).items():
+            for name in names:
+                indexes[kind].add(name)
+    
+    with autocomplete_lock:
+        if not pending and autocomplete_generations.get(user_id, 0) == generation:
+            indexes = autocomplete_indexes.setdefault(user_id, indexes)
+    return indexes
+
+class SimilarityIndex:
+    """IDF-weighted cosine similarity over tag and ingredient features.
+    
+    Features are stored column-wise (recipe rows per feature), so scoring
+    one recipe against all others is a single bincount over the rows of
+    its features.
+    """
+    
+    def __init__(self, rows):
+        vocabulary = {}
+        row_ptr = [0]
+        cols = []
+        for _, tags, ingredients in rows:
+            terms = recipe_terms(tags, ingredients)
+            features = {f'tag:{name.lower()}' for name in terms['tag']}
+            features |= {f'ingredient:{name.lower()}' for name in terms['ingredient']}
+            cols.extend(vocabulary.setdefault(feature, len(vocabulary)) for feature in features)
+            row_ptr.append(len(cols))
+        
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.row_ptr = np.array(row_ptr, dtype=np.int64)
+        self.cols = np.array(cols, dtype=np.int64)
+        rows_of_cols = np.repeat(np.arange(len(rows)), np.diff(self.row_ptr))
+        
+        order = np.argsort(self.cols, kind='stable')
+        df = np.bincount(self.cols, minlength=len(vocabulary))
+        self.col_rows = rows_of_cols[order]
+        self.col_ptr = np.concatenate(([0], np.cumsum(df)))
+        
+        self.weights = (np.log(max(len(rows), 1) / np.maximum(df, 1)) + 1) ** 2
+        self.norms = np.sqrt(np.bincount(rows_of_cols, weights=self.weights[self.cols], minlength=len(rows)))
+    
+    def position(self, recipe_id):
+        pos = np.searchsorted(self.ids, recipe_id)
+        if pos < len(self.ids) and self.ids[pos] == recipe_id:
+            return int(pos)
+        return None
+    
+    def similar(self, pos, limit):
+        """Returns [(recipe_id, score)] of the best matches, best first"""
+        cols = self.cols[self.row_ptr[pos]:self.row_ptr[pos + 1]]
+        if not len(cols) or not len(self.ids):
+            return []
+        
+        starts, ends = self.col_ptr[cols], self.col_ptr[cols + 1]
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        dots = np.bincount(
+            self.col_rows[offsets],
+            weights=np.repeat(self.weights[cols], lengths),
+            minlength=len(self.ids)
+        )
+        
+        scores = dots / (self.norms * self.norms[pos] + 1e-12)
+        scores[pos] = 0
+        
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(self.ids[i]), float(scores[i])) for i in candidates]
+
+similarity_indexes = {}
+similarity_generations = {}
+similarity_lock = threading.Lock()
+
+def get_similarity_index(user_id):
+    """Built on first use, dropped by recipe writes"""
+    with similarity_lock:
+        index = similarity_indexes.get(user_id)
+        generation = similarity_generations.get(user_id, 0)
+    if index is not None:
+        return index
+    
+    rows = db.session.query(Recipe.id, Recipe.tags, Recipe.ingredients) \
+        .filter_by(user_id=user_id).order_by(Recipe.id).all()
+    index = SimilarityIndex(rows)
+    
+    with similarity_lock:
+        if similarity_generations.get(user_id, 0) == generation:
+            similarity_indexes[user_id] = index
+    return index
+
+def invalidate_similarity(user_id):
+    with similarity_lock:
+        similarity_indexes.pop(user_id, None)
+        similarity_generations[user_id] = similarity_generations.get(user_id, 0) + 1
+
+@contextmanager
+def autocomplete_write(user_id):
+    """Wraps the commit of a recipe change, the caller sets 'old'/'new' terms once committed"""
+    terms = {}
+    with autocomplete_lock:
+        autocomplete_pending[user_id] = autocomplete_pending.get(user_id, 0) + 1
+        autocomplete_generations[user_id] = autocomplete_generations.get(user_id, 0) + 1
+    
+    try:
+        yield terms
+    finally:
+        with autocomplete_lock:
+            autocomplete_pending[user_id] -= 1
+            indexes = autocomplete_indexes.get(user_id)
+            if indexes is not None:
+                for key, delta in (('old', -1), ('new', 1)):
+                    for kind, names in terms.get(key, {}).items():
+                        for name in names:
+                            indexes[kind].add(name, delta)
 
 @app.route('/')
 def index():
@@ -202,6 +757,7 @@ def check_auth():
 
 @log_response
 @app.route('/api/recipes', methods=['GET'])
+@coalesce
 def get_recipes():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -250,8 +806,14 @@ def create_recipe():
         rate=data.get('rate', 5)
     )
     
-    db.session.add(new_recipe)
-    db.session.commit()
+    new_terms = recipe_terms(new_recipe.tags, new_recipe.ingredients)
+    
+    with autocomplete_write(session['user_id']) as terms:
+        db.session.add(new_recipe)
+        db.session.commit()
+        terms['new'] = new_terms
+    bump_write_generation(session['user_id'])
+    invalidate_similarity(session['user_id'])
     
     return jsonify({
         'id': new_recipe.id,
@@ -269,7 +831,7 @@ def get_recipe(recipe_id):
     if not recipe:
         return jsonify({'error': 'Recipe not found'}), 404
     
-    return jsonify({
+    response = jsonify({
         'id': recipe.id,
         'title': recipe.title,
         'rate': recipe.rate,
@@ -278,8 +840,11 @@ def get_recipe(recipe_id):
         'ingredients': json.loads(recipe.ingredients),
         'content': recipe.content,
         'tags': json.loads(recipe.tags),
-        'created_at': recipe.created_at.strftime('%Y-%m-%d %H:%M')
-    }), 200
+        'created_at': recipe.created_at.strftime('%Y-%m-%d %H:%M'),
+        'version': recipe.version
+    })
+    response.set_etag(str(recipe.version))
+    return response, 200
 
 @app.route('/api/recipes/<int:recipe_id>', methods=['PUT'])
 @log_response
@@ -292,6 +857,10 @@ def update_recipe(recipe_id):
     recipe = Recipe.query.filter_by(id=recipe_id, user_id=session['user_id']).first()
     if not recipe:
         return jsonify({'error': 'Recipe not found'}), 404
+    if request.if_match and not request.if_match.contains(str(recipe.version)):
+        return jsonify({'error': 'Recipe was changed, reload it and try again'}), 412
+    
+    old_terms = recipe_terms(recipe.tags, recipe.ingredients)
     
     recipe.title = data.get('title', recipe.title)
     recipe.rate = data.get('rate', recipe.rate)
@@ -300,14 +869,128 @@ def update_recipe(recipe_id):
     recipe.ingredients = json.dumps(data.get('ingredients', []))
     recipe.content = data.get('content', recipe.content)
     recipe.tags = json.dumps(data.get('tags', []))
+    new_terms = recipe_terms(recipe.tags, recipe.ingredients)
     
-    db.session.commit()
+    with autocomplete_write(session['user_id']) as terms:
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return jsonify({'error': 'Recipe was changed, reload it and try again'}), 412
+        terms.update(old=old_terms, new=new_terms)
+    bump_write_generation(session['user_id'])
+    invalidate_similarity(session['user_id'])
     
-    return jsonify({
+    response = jsonify({
         'id': recipe.id,
         'title': recipe.title,
-        'rate': recipe.rate
-    }), 200
+        'rate': recipe.rate,
+        'version': recipe.version
+    })
+    response.set_etag(str(recipe.version))
+    return response, 200
+
+@app.route('/api/recipes/<int:recipe_id>', methods=['PATCH'])
+@log_response
+def patch_recipe(recipe_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.json
+    
+    if not isinstance(data, dict) or not data:
+        return jsonify({'error': 'Need fields to update'}), 400
+    unknown = sorted(set(data) - set(RECIPE_FIELDS))
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+    if 'title' in data and not data['title']:
+        return jsonify({'error': 'Need title'}), 400
+    if 'tags' in data and not isinstance(data['tags'], list):
+        return jsonify({'error': 'Tags must be a list'}), 400
+    if 'ingredients' in data and not (
+        isinstance(data['ingredients'], list) and all(isinstance(t, dict) for t in data['ingredients'])
+    ):
+        return jsonify({'error': 'Ingredients must be a list of objects'}), 400
+    
+    terms_changed = 'tags' in data or 'ingredients' in data
+    columns = [Recipe.version]
+    if terms_changed:
+        columns += [Recipe.tags, Recipe.ingredients]
+    
+    current = db.session.query(*columns).filter_by(id=recipe_id, user_id=session['user_id']).first()
+    if not current:
+        return jsonify({'error': 'Recipe not found'}), 404
+    if request.if_match and not request.if_match.contains(str(current.version)):
+        return jsonify({'error': 'Recipe was changed, reload it and try again'}), 412
+    
+    values = {}
+    for field in RECIPE_FIELDS:
+        if field in data:
+            value = data[field]
+            if field in ('ingredients', 'tags'):
+                value = json.dumps(value)
+            values[getattr(Recipe, field)] = value
+    values[Recipe.version] = current.version + 1
+    
+    with autocomplete_write(session['user_id']) as terms:
+        updated = Recipe.query.filter_by(
+            id=recipe_id, user_id=session['user_id'], version=current.version
+        ).update(values, synchronize_session=False)
+        if not updated:
+            db.session.rollback()
+            return jsonify({'error': 'Recipe was changed, reload it and try again'}), 412
+        db.session.commit()
+        
+        if terms_changed:
+            terms.update(
+                old=recipe_terms(current.tags, current.ingredients),
+                new=recipe_terms(values.get(Recipe.tags, current.tags), values.get(Recipe.ingredients, current.ingredients))
+            )
+    
+    bump_write_generation(session['user_id'])
+    if terms_changed:
+        invalidate_similarity(session['user_id'])
+    
+    response = jsonify({'id': recipe_id, 'version': current.version + 1})
+    response.set_etag(str(current.version + 1))
+    return response, 200
+
+@app.route('/api/recipes/<int:recipe_id>/similar')
+@log_response
+def get_similar_recipes(recipe_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    index = get_similarity_index(session['user_id'])
+    pos = index.position(recipe_id)
+    if pos is None:
+        return jsonify({'error': 'Recipe not found'}), 404
+    
+    limit = min(max(request.args.get('limit', 5, type=int), 1), 50)
+    scores = dict(index.similar(pos, limit))
+    
+    recipes = {}
+    if scores:
+        recipes = {
+            recipe.id: recipe for recipe in
+            db.session.query(Recipe.id, Recipe.title, Recipe.rate, Recipe.description, Recipe.tags)
+            .filter(Recipe.user_id == session['user_id'], Recipe.id.in_(list(scores))).all()
+        }
+    
+    result = []
+    for similar_id, score in scores.items():
+        recipe = recipes.get(similar_id)
+        if recipe:
+            result.append({
+                'id': recipe.id,
+                'title': recipe.title,
+                'rate': recipe.rate,
+                'description': recipe.description,
+                'tags': load_json_list(recipe.tags),
+                'score': round(score, 4)
+            })
+    
+    return jsonify({'recipes': result}), 200
 
 @app.route('/api/recipes/<int:recipe_id>', methods=['DELETE'])
 @log_response
@@ -319,13 +1002,24 @@ def delete_recipe(recipe_id):
     if not recipe:
         return jsonify({'error': 'Recipe not found'}), 404
     
-    db.session.delete(recipe)
-    db.session.commit()
+    old_terms = recipe_terms(recipe.tags, recipe.ingredients)
+    
+    with autocomplete_write(session['user_id']) as terms:
+        try:
+            db.session.delete(recipe)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return jsonify({'error': 'Recipe was changed, reload it and try again'}), 412
+        terms['old'] = old_terms
+    bump_write_generation(session['user_id'])
+    invalidate_similarity(session['user_id'])
     
     return jsonify({'success': True, 'message': 'Recipe deleted'}), 200
 
 @app.route('/api/tags')
 @log_response
+@coalesce
 def get_tags():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -386,5 +1080,78 @@ def get_meals():
     
     return jsonify({"meals": sorted(ingredients, key=lambda t: (t['name'], t['unit']))}), 200
 
+@app.route('/api/autocomplete')
+@log_response
+def autocomplete():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    kind = request.args.get('kind')
+    if kind not in ('tag', 'ingredient'):
+        return jsonify({'error': 'Kind must be tag or ingredient'}), 400
+    
+    prefix = request.args.get('prefix', '').strip()
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    
+    indexes = get_autocomplete_index(session['user_id'])
+    with autocomplete_lock:
+        suggestions = indexes[kind].complete(prefix, limit)
+    
+    return jsonify({'suggestions': suggestions}), 200
+
+@app.route('/api/slow-queries')
+@log_response
+def get_slow_queries():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    
+    with slow_query_lock:
+        worst = sorted(slow_query_stats.values(), key=lambda t: t['total_ms'], reverse=True)
+        result = []
+        for stats in worst[:limit]:
+            result.append({
+                'statement': stats['statement'],
+                'count': stats['count'],
+                'total_ms': round(stats['total_ms'], 2),
+                'avg_ms': round(stats['total_ms'] / stats['count'], 2),
+                'max_ms': round(stats['max_ms'], 2),
+                'params': stats['params'],
+                'plan': stats['plan'],
+                'full_scan': stats['full_scan'],
+                'routes': sorted(stats['routes'])
+            })
+    
+    return jsonify({'queries': result}), 200
+
+@app.route('/api/rate-limits')
+@log_response
+def get_rate_limits():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    with rate_limit_lock:
+        endpoints = {name: dict(counters) for name, counters in rate_limit_counters.items()}
+    
+    return jsonify({'endpoints': endpoints, 'shed': app.wsgi_app.shed}), 200
+
+@app.route('/api/coalescing')
+@log_response
+def get_coalescing():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    with coalesce_lock:
+        endpoints = {name: dict(counters) for name, counters in coalesce_counters.items()}
+    
+    return jsonify({'endpoints': endpoints}), 200
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,12 +1,20 @@
 import pytest
 import json
+import threading
+import time
+import requests
 from datetime import datetime
+from werkzeug.serving import make_server
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from server import app, db, User, Recipe
+import server
+from server import (app, db, User, Recipe, slow_query_stats, normalize_statement, param_shape,
+                    MemoryBucketStore, rate_limit_counters, PrefixIndex, autocomplete_indexes,
+                    autocomplete_write, get_autocomplete_index,
+                    SingleFlight, coalesce_counters, SimilarityIndex, similarity_indexes)
 
 # =================== FIXTURES ===================
 
@@ -14,6 +22,7 @@ from server import app, db, User, Recipe
 def client():
     app.config['TESTING'] = True
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    app.config['RATE_LIMIT_STORE'] = MemoryBucketStore()
     
     with app.test_client() as client:
         with app.app_context():
@@ -137,6 +146,7 @@ class TestErrorHandling:
             ('/api/recipes', 'POST'),
             ('/api/recipes/1', 'GET'),
             ('/api/recipes/1', 'PUT'),
+            ('/api/recipes/1', 'PATCH'),
             ('/api/recipes/1', 'DELETE'),
             ('/api/tags', 'GET'),
             ('/api/meals', 'GET'),
@@ -149,6 +159,8 @@ class TestErrorHandling:
                 response = client.post(endpoint)
             elif method == 'PUT':
                 response = client.put(endpoint)
+            elif method == 'PATCH':
+                response = client.patch(endpoint)
             elif method == 'DELETE':
                 response = client.delete(endpoint)
             
@@ -420,6 +432,532 @@ class TestIntegrationScenarios:
         
         assert {'name': 'Cheese', 'amount': 150, 'unit': 'g'} in meals  # 100 + 50 = 150
 
+# =================== PROFILING ===================
+
+class TestProfiling:
+    @pytest.fixture
+    def profile_dir(self, tmp_path):
+        app.config['PROFILE_DIR'] = str(tmp_path)
+        yield tmp_path
+        app.config['PROFILE_DIR'] = 'logs'
+        app.config['ADMIN_EMAILS'] = []
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        app.config['PROFILE_MAX_FILES'] = 50
+    
+    def test_admin_header_writes_profile(self, client, auth_headers, test_user, profile_dir):
+        app.config['ADMIN_EMAILS'] = [test_user.email]
+        
+        response = client.get('/api/tags', headers={**auth_headers, 'X-Profile': '1'})
+        assert response.status_code == 200
+        
+        profiles = list(profile_dir.glob('profile-*.pstats'))
+        assert len(profiles) == 1
+        assert 'api_tags' in profiles[0].name
+        assert f'-u{test_user.id}-' in profiles[0].name
+    
+    def test_header_ignored_for_non_admin(self, client, auth_headers, profile_dir):
+        response = client.get('/api/tags', headers={**auth_headers, 'X-Profile': '1'})
+        assert response.status_code == 200
+        assert list(profile_dir.glob('profile-*.pstats')) == []
+    
+    def test_sampling_respects_retention(self, client, auth_headers, profile_dir):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        app.config['PROFILE_MAX_FILES'] = 2
+        
+        for _ in range(4):
+            client.get('/api/tags', headers=auth_headers)
+        
+        assert len(list(profile_dir.glob('profile-*.pstats'))) == 2
+    
+    def test_cleanup_skips_vanished_files(self, client, auth_headers, profile_dir, monkeypatch):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        client.get('/api/check-auth')
+        getmtime = os.path.getmtime
+        
+        def vanished(path):
+            if 'check_auth' in str(path):
+                raise FileNotFoundError(path)
+            return getmtime(path)
+        
+        monkeypatch.setattr(os.path, 'getmtime', vanished)
+        assert client.get('/api/check-auth').status_code == 200
+    
+    def test_failing_request_is_profiled(self, client, auth_headers, profile_dir):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        view = app.view_functions['get_tags']
+        
+        def broken_view():
+            raise RuntimeError('broken')
+        
+        app.view_functions['get_tags'] = broken_view
+        try:
+            with pytest.raises(RuntimeError):
+                client.get('/api/tags', headers=auth_headers)
+        finally:
+            app.view_functions['get_tags'] = view
+        # the test client keeps the failed request context until the next request
+        client.get('/api/check-auth')
+        
+        assert len(list(profile_dir.glob('profile-*-error.pstats'))) == 1
+
+# =================== SLOW QUERIES ===================
+
+class TestSlowQueries:
+    @pytest.fixture
+    def record_all(self):
+        app.config['SLOW_QUERY_MS'] = 0
+        slow_query_stats.clear()
+        yield
+        app.config['SLOW_QUERY_MS'] = 100
+        app.config['ADMIN_EMAILS'] = []
+        slow_query_stats.clear()
+    
+    def test_normalize_and_param_shape(self):
+        assert normalize_statement('SELECT *\n  FROM recipe WHERE id IN (?, ?, ?)') == \
+            'SELECT * FROM recipe WHERE id IN (?...)'
+        assert param_shape((1, 'a', 'b', 'c')) == 'int, str*3'
+    
+    def test_like_query_flagged_as_full_scan(self, client, auth_headers, test_user, record_all):
+        app.config['ADMIN_EMAILS'] = [test_user.email]
+        client.get('/api/recipes?tags=italian', headers=auth_headers)
+        
+        response = client.get('/api/slow-queries', headers=auth_headers)
+        assert response.status_code == 200
+        queries = response.get_json()['queries']
+        
+        like_queries = [q for q in queries if 'LIKE' in q['statement']]
+        assert len(like_queries) == 1
+        assert like_queries[0]['full_scan']
+        assert like_queries[0]['plan']
+        assert like_queries[0]['routes'] == ['/api/recipes']
+        
+        response = client.get('/api/slow-queries?limit=-1', headers=auth_headers)
+        assert len(response.get_json()['queries']) == 1
+    
+    def test_summary_requires_admin(self, client, auth_headers, record_all):
+        response = client.get('/api/slow-queries', headers=auth_headers)
+        assert response.status_code == 403
+
+# =================== RATE LIMITING ===================
+
+class TestRateLimiting:
+    @pytest.fixture
+    def fresh_store(self):
+        store = app.config['RATE_LIMIT_STORE']
+        app.config['RATE_LIMIT_STORE'] = MemoryBucketStore()
+        yield app.config['RATE_LIMIT_STORE']
+        app.config['RATE_LIMIT_STORE'] = store
+        app.config['RATE_LIMIT_USER'] = (20, 100)
+        app.config['RATE_LIMIT_ROUTES'] = {}
+        app.config['ADMIN_EMAILS'] = []
+    
+    def test_bucket_refills(self):
+        store = MemoryBucketStore()
+        assert store.take('key', 1000, 2, 2) == 0
+        assert store.take('key', 1000, 2, 2) > 0
+    
+    def test_prune_uses_each_bucket_limits(self):
+        store = MemoryBucketStore(max_keys=4)
+        store.take('user:1', 1000, 10, 1)
+        store.take('user:2', 0.001, 10, 5)
+        store.take('ip:1', 0.001, 300, 150)
+        store.take('user:3', 0.001, 10, 5)
+        time.sleep(0.01)
+        store.take('user:4', 0.001, 10, 5)
+        
+        # user:1 has refilled, the half empty ip bucket outlives the older user:2
+        assert list(store.buckets) == ['ip:1', 'user:3', 'user:4']
+        assert store.buckets['ip:1'][0] == pytest.approx(150, abs=0.1)
+    
+    def test_route_override(self, client, auth_headers, fresh_store):
+        app.config['RATE_LIMIT_ROUTES'] = {'get_recipes': {'user': (0.001, 1)}}
+        
+        assert client.get('/api/recipes', headers=auth_headers).status_code == 200
+        assert client.get('/api/recipes', headers=auth_headers).status_code == 429
+        assert client.get('/api/check-auth', headers=auth_headers).status_code == 200
+    
+    def test_heavy_endpoint_costs_more(self, client, auth_headers, test_user, fresh_store):
+        app.config['RATE_LIMIT_USER'] = (0.001, 10)
+        
+        assert client.get('/api/tags', headers=auth_headers).status_code == 200
+        assert client.get('/api/tags', headers=auth_headers).status_code == 200
+        response = client.get('/api/tags', headers=auth_headers)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+        
+        assert rate_limit_counters['get_tags']['limited'] >= 1
+    
+    def test_concurrency_cap_sheds_load(self, client, auth_headers):
+        limiter = app.wsgi_app
+        slots = limiter.slots
+        limiter.slots = threading.BoundedSemaphore(1)
+        limiter.slots.acquire()
+        try:
+            response = client.get('/api/recipes', headers=auth_headers)
+        finally:
+            limiter.slots = slots
+        
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+    
+    def test_counters_for_admin(self, client, auth_headers, test_user, fresh_store):
+        app.config['ADMIN_EMAILS'] = [test_user.email]
+        response = client.get('/api/rate-limits', headers=auth_headers)
+        assert response.status_code == 200
+        assert 'shed' in response.get_json()
+
+# =================== AUTOCOMPLETE ===================
+
+class TestAutocomplete:
+    @pytest.fixture
+    def empty_indexes(self):
+        autocomplete_indexes.clear()
+        yield
+        autocomplete_indexes.clear()
+    
+    def test_prefix_index_ranking(self):
+        index = PrefixIndex()
+        for name in ['Sugar', 'salt', 'salt', 'Salmon', 'pepper']:
+            index.add(name)
+        
+        assert [t['name'] for t in index.complete('sa', 10)] == ['salt', 'Salmon']
+        assert index.complete('S', 1) == [{'name': 'salt', 'count': 2}]
+        
+        index.add('salt', -2)
+        assert [t['name'] for t in index.complete('sa', 10)] == ['Salmon']
+    
+    def test_autocomplete_follows_recipe_writes(self, client, auth_headers, test_recipe, empty_indexes):
+        response = client.get('/api/autocomplete?kind=ingredient&prefix=fl', headers=auth_headers)
+        assert response.status_code == 200
+        assert response.get_json()['suggestions'] == [{'name': 'Flour', 'count': 1}]
+        
+        client.post('/api/recipes',
+                    json={'title': 'Bread', 'tags': ['baking', 'bread'], 'ingredients': []},
+                    headers=auth_headers)
+        response = client.get('/api/autocomplete?kind=tag&prefix=b', headers=auth_headers)
+        assert response.get_json()['suggestions'] == [
+            {'name': 'baking', 'count': 2},
+            {'name': 'bread', 'count': 1}
+        ]
+        
+        client.delete(f'/api/recipes/{test_recipe.id}', headers=auth_headers)
+        response = client.get('/api/autocomplete?kind=ingredient&prefix=fl', headers=auth_headers)
+        assert response.get_json()['suggestions'] == []
+    
+    @pytest.mark.parametrize('payload', [
+        {'ingredients': ['flour']},
+        {'ingredients': None, 'tags': None},
+        {'ingredients': [{'name': 5}], 'tags': [1, {'a': 'b'}]},
+    ])
+    def test_malformed_recipe_can_be_created_and_deleted(self, client, auth_headers, empty_indexes, payload):
+        client.get('/api/autocomplete?kind=tag&prefix=a', headers=auth_headers)
+        
+        response = client.post('/api/recipes', json={'title': 'Odd', **payload}, headers=auth_headers)
+        assert response.status_code == 201
+        recipe_id = response.get_json()['id']
+        
+        autocomplete_indexes.clear()
+        response = client.get('/api/autocomplete?kind=ingredient&prefix=f', headers=auth_headers)
+        assert response.status_code == 200
+        assert response.get_json()['suggestions'] == []
+        
+        response = client.delete(f'/api/recipes/{recipe_id}', headers=auth_headers)
+        assert response.status_code == 200
+    
+    def test_build_during_write_does_not_count_twice(self, client, auth_headers, test_user, empty_indexes):
+        with autocomplete_write(test_user.id) as terms:
+            db.session.add(Recipe(user_id=test_user.id, title='Soup', tags='["soup"]', ingredients='[]'))
+            db.session.commit()
+            # a cold build between the commit and the index update sees the new row
+            assert get_autocomplete_index(test_user.id)['tag'].complete('soup', 5) == [{'name': 'soup', 'count': 1}]
+            terms['new'] = {'tag': {'soup'}, 'ingredient': set()}
+        
+        response = client.get('/api/autocomplete?kind=tag&prefix=soup&limit=0', headers=auth_headers)
+        assert response.get_json()['suggestions'] == [{'name': 'soup', 'count': 1}]
+    
+    def test_autocomplete_validation(self, client, auth_headers):
+        response = client.get('/api/autocomplete?kind=title&prefix=a', headers=auth_headers)
+        assert response.status_code == 400
+
+# =================== PARTIAL UPDATES ===================
+
+class TestPartialUpdates:
+    def test_patch_changes_only_given_fields(self, client, auth_headers, test_recipe):
+        response = client.patch(f'/api/recipes/{test_recipe.id}',
+                                json={'rate': 8},
+                                headers=auth_headers)
+        assert response.status_code == 200
+        assert response.get_json()['version'] == 2
+        
+        recipe = client.get(f'/api/recipes/{test_recipe.id}', headers=auth_headers).get_json()
+        assert recipe['rate'] == 8
+        assert recipe['tags'] == ['test', 'baking']
+        assert len(recipe['ingredients']) == 2
+        assert recipe['content'] == 'Test content'
+    
+    def test_if_match_conflict(self, client, auth_headers, test_recipe):
+        response = client.get(f'/api/recipes/{test_recipe.id}', headers=auth_headers)
+        etag = response.headers['ETag']
+        
+        response = client.patch(f'/api/recipes/{test_recipe.id}',
+                                json={'title': 'From phone'},
+                                headers={**auth_headers, 'If-Match': etag})
+        assert response.status_code == 200
+        
+        response = client.patch(f'/api/recipes/{test_recipe.id}',
+                                json={'title': 'From laptop'},
+                                headers={**auth_headers, 'If-Match': etag})
+        assert response.status_code == 412
+        
+        response = client.put(f'/api/recipes/{test_recipe.id}',
+                              json={'title': 'From laptop'},
+                              headers={**auth_headers, 'If-Match': etag})
+        assert response.status_code == 412
+        
+        recipe = client.get(f'/api/recipes/{test_recipe.id}', headers=auth_headers).get_json()
+        assert recipe['title'] == 'From phone'
+    
+    @pytest.mark.parametrize('payload', [
+        {}, {'owner': 2}, {'title': ''},
+        {'tags': 'abc'}, {'ingredients': ['flour']}, {'ingredients': None}
+    ])
+    def test_patch_validation(self, client, auth_headers, test_recipe, payload):
+        response = client.patch(f'/api/recipes/{test_recipe.id}',
+                                json=payload,
+                                headers=auth_headers)
+        assert response.status_code == 400
+        
+        recipe = client.get(f'/api/recipes/{test_recipe.id}', headers=auth_headers).get_json()
+        assert recipe['version'] == 1
+        assert recipe['tags'] == ['test', 'baking']
+
+# =================== REQUEST COALESCING ===================
+
+class TestCoalescing:
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+        
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'recipes'
+        
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        time.sleep(0.1)  # let the other threads reach the wait
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        assert len(calls) == 1
+        assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+        assert all(result == 'recipes' for result, _ in results)
+        assert flight.calls == {}
+    
+    def test_errors_reach_every_caller(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+        
+        def compute():
+            started.set()
+            release.wait(5)
+            raise ValueError('broken')
+        
+        def call():
+            try:
+                flight.do('key', compute)
+            except ValueError as e:
+                errors.append(e)
+        
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=call) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.1)  # let the followers reach the wait
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        
+        assert len(errors) == 5
+        assert flight.calls == {}
+    
+    def test_waiting_is_bounded(self):
+        flight = SingleFlight(timeout=0.05)
+        release = threading.Event()
+        started = threading.Event()
+        
+        def stuck():
+            started.set()
+            release.wait(5)
+            return 'late'
+        
+        leader = threading.Thread(target=flight.do, args=('key', stuck))
+        leader.start()
+        started.wait(5)
+        try:
+            assert flight.do('key', lambda: 'own') == ('own', False)
+        finally:
+            release.set()
+            leader.join()
+    
+    def test_concurrent_route_requests_are_coalesced(self, client, test_user, test_recipe, monkeypatch):
+        class SlowFlight(SingleFlight):
+            def do(self, key, fn):
+                def slow():
+                    time.sleep(0.3)
+                    return fn()
+                return super().do(key, slow)
+        
+        monkeypatch.setattr(server, 'single_flight', SlowFlight())
+        monkeypatch.setitem(app.config, 'RATE_LIMIT_ENABLED', False)
+        coalesce_counters.clear()
+        
+        http = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=http.serve_forever)
+        thread.start()
+        try:
+            base = f'http://127.0.0.1:{http.server_port}'
+            cookies = requests.post(f'{base}/api/login',
+                                    json={'email': test_user.email, 'password': 'testpass123'}).cookies
+            
+            responses = []
+            def fetch():
+                responses.append(requests.get(f'{base}/api/tags', cookies=cookies))
+            
+            threads = [threading.Thread(target=fetch) for _ in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            http.shutdown()
+            thread.join()
+        
+        assert [r.status_code for r in responses] == [200] * 20
+        assert all(r.json() == responses[0].json() for r in responses)
+        assert coalesce_counters['get_tags'] == {'executed': 1, 'coalesced': 19}
+    
+    def test_reads_after_a_write_do_not_join_older_calls(self, client, test_user, monkeypatch):
+        first = threading.Event()
+        
+        class SlowFlight(SingleFlight):
+            def do(self, key, fn):
+                def slow():
+                    result = fn()
+                    if not first.is_set():
+                        # the first read has its result but is still in flight
+                        first.set()
+                        time.sleep(0.5)
+                    return result
+                return super().do(key, slow)
+        
+        monkeypatch.setattr(server, 'single_flight', SlowFlight())
+        
+        http = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=http.serve_forever)
+        thread.start()
+        try:
+            base = f'http://127.0.0.1:{http.server_port}'
+            cookies = requests.post(f'{base}/api/login',
+                                    json={'email': test_user.email, 'password': 'testpass123'}).cookies
+            
+            before = []
+            reader = threading.Thread(
+                target=lambda: before.append(requests.get(f'{base}/api/tags', cookies=cookies)))
+            reader.start()
+            first.wait(5)
+            
+            requests.post(f'{base}/api/recipes', json={'title': 'Soup', 'tags': ['soup']}, cookies=cookies)
+            after = requests.get(f'{base}/api/tags', cookies=cookies)
+            reader.join()
+        finally:
+            http.shutdown()
+            thread.join()
+        
+        assert before[0].json()['tags'] == []
+        assert after.json()['tags'] == [{'name': 'soup', 'count': 1}]
+    
+    def test_coalesced_route_returns_same_response(self, client, auth_headers, test_recipe):
+        coalesce_counters.clear()
+        response = client.get('/api/recipes?tags=test', headers=auth_headers)
+        assert response.status_code == 200
+        assert response.get_json()['recipes'][0]['title'] == 'Test Recipe'
+        assert coalesce_counters['get_recipes'] == {'executed': 1, 'coalesced': 0}
+
+# =================== SIMILAR RECIPES ===================
+
+class TestSimilarRecipes:
+    @pytest.fixture
+    def empty_indexes(self):
+        similarity_indexes.clear()
+        yield
+        similarity_indexes.clear()
+    
+    def test_cosine_scores(self):
+        rows = [
+            (1, json.dumps(['pasta']), json.dumps([{'name': 'Flour'}, {'name': 'Eggs'}])),
+            (2, json.dumps(['pasta']), json.dumps([{'name': 'flour'}, {'name': 'Eggs'}])),
+            (3, json.dumps(['cake']), json.dumps([{'name': 'Flour'}, {'name': 'Sugar'}])),
+            (4, json.dumps(['salad']), json.dumps([{'name': 'Lettuce'}])),
+        ]
+        index = SimilarityIndex(rows)
+        
+        similar = index.similar(index.position(1), 10)
+        assert [recipe_id for recipe_id, _ in similar] == [2, 3]
+        assert similar[0][1] == pytest.approx(1.0)
+        assert 0 < similar[1][1] < 1
+        assert index.position(5) is None
+    
+    def test_similar_endpoint_and_invalidation(self, client, auth_headers, test_recipe, empty_indexes):
+        response = client.get(f'/api/recipes/{test_recipe.id}/similar', headers=auth_headers)
+        assert response.status_code == 200
+        assert response.get_json()['recipes'] == []
+        
+        response = client.post('/api/recipes',
+                               json={'title': 'Cookies', 'tags': ['baking'],
+                                     'ingredients': [{'name': 'Sugar', 'amount': 50, 'unit': 'g'}]},
+                               headers=auth_headers)
+        cookies_id = response.get_json()['id']
+        
+        response = client.get(f'/api/recipes/{test_recipe.id}/similar', headers=auth_headers)
+        recipes = response.get_json()['recipes']
+        assert [recipe['id'] for recipe in recipes] == [cookies_id]
+        assert recipes[0]['title'] == 'Cookies'
+        
+        response = client.get('/api/recipes/999/similar', headers=auth_headers)
+        assert response.status_code == 404
+    
+    def test_malformed_stored_json(self, client, auth_headers, test_user, test_recipe, empty_indexes):
+        for tags, ingredients in [('null', '["flour"]'), ('"abc"', 'not json'), ('["baking"]', '[1, {"name": null}]')]:
+            db.session.add(Recipe(user_id=test_user.id, title='Odd', tags=tags, ingredients=ingredients))
+        shares_flour = Recipe(user_id=test_user.id, title='Bread', ingredients='[{"name": "Flour"}]')
+        db.session.add(shares_flour)
+        db.session.commit()
+        db.session.execute(db.text('UPDATE recipe SET tags = NULL WHERE id = :id'), {'id': shares_flour.id})
+        db.session.commit()
+        
+        response = client.get(f'/api/recipes/{test_recipe.id}/similar?limit=0', headers=auth_headers)
+        assert response.status_code == 200
+        recipes = response.get_json()['recipes']
+        assert len(recipes) == 1
+        
+        response = client.get(f'/api/recipes/{test_recipe.id}/similar', headers=auth_headers)
+        assert response.status_code == 200
+        recipes = {recipe['title']: recipe for recipe in response.get_json()['recipes']}
+        assert recipes['Bread']['tags'] == []
+
 # =================== TESTS START ===================
 
 if __name__ == '__main__':